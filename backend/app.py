@@ -1,4 +1,5 @@
 import os
+import atexit
 from flask import Flask, request, jsonify, send_file
 import torch
 from PIL import Image
@@ -9,32 +10,218 @@ import numpy as np
 from datetime import datetime
 import sqlite3
 import base64
-from typing import Optional
+import queue
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterable, Optional
+from cachetools import LRUCache
 from flask_cors import CORS
+from werkzeug.utils import secure_filename
+
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+try:
+    from simd_fallback import cosine_matrix
+except ImportError:
+    cosine_matrix = None
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+class _ImageTower(torch.nn.Module):
+    """CLIP vision tower plus projection, as a standalone module for ONNX export."""
+
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+class _TextTower(torch.nn.Module):
+    """CLIP text tower plus projection, as a standalone module for ONNX export."""
+
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+
 class ImageSearchEngine:
-    def __init__(self, images_dir: str = "images", database_path: str = "image_database.db"):
+    # Maximum number of uploads embedded in one forward pass, and how long to wait to fill a batch
+    BATCH_SIZE = 16
+    BATCH_TIMEOUT = 0.05
+    # Below this many images a brute-force scan is both exact and fast enough
+    ANN_MIN_IMAGES = 1000
+    ANN_EF_SEARCH = 64
+    # Vectors added between two saves of the HNSW index; it is also saved at shutdown
+    ANN_SAVE_INTERVAL = 1000
+
+    # Rows scored per block by the NumPy similarity fallback (4096 x 512 float32 = 8 MB)
+    SIMILARITY_BLOCK_ROWS = 4096
+
+    # Conservative bound on parameters per statement (older SQLite builds allow 999)
+    MAX_SQL_PARAMS = 900
+
+    # SQL run on every upload/query; sqlite3 caches the compiled statements by their text
+    INSERT_IMAGE_SQL = """
+        INSERT INTO images (filename, original_filename, upload_date, description, embedding, scale, row_index)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """
+
+    # Initial number of rows reserved in the embedding file; it doubles whenever it fills up
+    EMBEDDINGS_INITIAL_CAPACITY = 1024
+
+    def __init__(self, images_dir: str = "images", database_path: str = "image_database.db",
+                 use_ann: bool = True, use_onnx: bool = True):
         """Initialize the image search engine with a directory of images and database."""
         self.images_dir = Path(images_dir)
         self.images_dir.mkdir(exist_ok=True)
         self.database_path = database_path
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # Half precision roughly doubles throughput on GPU without hurting embedding quality
+        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
         
         # Load CLIP model and processor
         self.model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
         self.processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-        self.model.to(self.device)
+        self.image_size = self.processor.image_processor.crop_size["height"]
+
+        # Serve both towers through ONNX Runtime when it is installed; export them once (in FP32)
+        self._vision_session = None
+        self._text_session = None
+        if use_onnx and ort is not None:
+            try:
+                self._init_onnx_sessions()
+            except Exception:
+                app.logger.exception("Failed to set up ONNX Runtime; falling back to PyTorch")
+                self._vision_session = None
+                self._text_session = None
+
+        # FP16 and channels_last only matter for the eager path; when ONNX Runtime serves both
+        # towers the torch model is never run, so leave it on the CPU instead of taking up VRAM
+        if self._vision_session is None:
+            self.model.to(self.device, dtype=self.dtype)
+            self.model = self.model.to(memory_format=torch.channels_last)
         
+        # One long-lived write connection in WAL mode; writes are serialized by a lock
+        self._conn = sqlite3.connect(self.database_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        self._write_lock = threading.Lock()
+
         # Initialize database
         self._init_database()
+
+        # Reads use their own connection, so they only ever see committed rows and, with WAL,
+        # never wait on the writer. Readers still share this one handle among themselves.
+        self._read_conn = sqlite3.connect(self.database_path, check_same_thread=False, isolation_level=None)
+        self._read_conn.execute("PRAGMA temp_store=MEMORY")
+        self._read_conn.execute("PRAGMA mmap_size=268435456")
+
+        # Memory-mapped int8 embedding matrix (N x D) of L2-normalized embeddings, their per-row
+        # quantization scales and the row ids it maps to. Row i belongs to the image whose row_index is i.
+        self.embeddings_path = Path(database_path).with_suffix(".embeddings.npy")
+        self._emb_store = None
+        self._emb_matrix = np.empty((0, self.model.config.projection_dim), dtype=np.int8)
+        self._scales = np.empty(0, dtype=np.float32)
+        self._row_ids: list = []
+        self._index_lock = threading.Lock()
+        self._load_embeddings()
+
+        # Text embeddings of recent queries, keyed by the normalized query string
+        self._text_cache = LRUCache(maxsize=1024)
+        self._text_cache_lock = threading.Lock()
+
+        # Optional HNSW index for sublinear top-k search over large libraries
+        self.ann_index_path = Path(database_path).with_suffix(".hnsw")
+        self._ann_unsaved = 0
+        self._ann_next_save = self.ANN_SAVE_INTERVAL
+        self._ann_save_lock = threading.Lock()
+        self._ann_index = self._init_ann_index() if use_ann and hnswlib is not None else None
+        if self._ann_index is not None:
+            atexit.register(self._flush_ann_index)
+
+        # Uploads are decoded on a thread pool and embedded in batches by a background worker
+        self._decode_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        self._pending = queue.Queue(maxsize=self.BATCH_SIZE * 8)
+        self._worker = threading.Thread(target=self._embedding_worker, daemon=True)
+        self._worker.start()
         
+    def _init_onnx_sessions(self):
+        """Export the CLIP towers to ONNX if needed and open an inference session for each."""
+        vision_path = self.images_dir / "clip_vision.onnx"
+        text_path = self.images_dir / "clip_text.onnx"
+        self.model.eval()
+
+        if not vision_path.exists():
+            dummy_pixel_values = torch.zeros(1, 3, self.image_size, self.image_size)
+            self._export_onnx(
+                _ImageTower(self.model), (dummy_pixel_values,), vision_path,
+                input_names=["pixel_values"], output_names=["image_embeds"],
+                dynamic_axes={"pixel_values": {0: "B"}, "image_embeds": {0: "B"}},
+            )
+        if not text_path.exists():
+            dummy = self.processor(text=["a photo"], return_tensors="pt", padding=True)
+            self._export_onnx(
+                _TextTower(self.model), (dummy["input_ids"], dummy["attention_mask"]), text_path,
+                input_names=["input_ids", "attention_mask"], output_names=["text_embeds"],
+                dynamic_axes={"input_ids": {0: "B", 1: "L"}, "attention_mask": {0: "B", 1: "L"},
+                              "text_embeds": {0: "B"}},
+            )
+
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider")
+                     if p in ort.get_available_providers()]
+        self._vision_session = ort.InferenceSession(str(vision_path), providers=providers)
+        self._text_session = ort.InferenceSession(str(text_path), providers=providers)
+
+    @staticmethod
+    def _export_onnx(module, args, path, **kwargs):
+        """Export a module to ONNX, writing a temp file first so an interrupted export never leaves a partial model."""
+        tmp_path = path.with_name(path.name + ".tmp")
+        try:
+            torch.onnx.export(module, args, str(tmp_path), opset_version=17, **kwargs)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    @contextmanager
+    def _transaction(self):
+        """Run a block of writes as a single transaction on the shared connection."""
+        with self._write_lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn.cursor()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                # A failed COMMIT can leave the transaction open; never leave the shared connection inside one
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
+
     def _init_database(self):
         """Initialize SQLite database with necessary tables."""
-        with sqlite3.connect(self.database_path) as conn:
-            cursor = conn.cursor()
+        with self._transaction() as cursor:
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS images (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -45,113 +232,553 @@ class ImageSearchEngine:
                     embedding BLOB NOT NULL
                 )
             """)
-            conn.commit()
+            self._migrate_database(cursor)
 
-    def load_and_process_image(self, image_path: str) -> torch.Tensor:
-        """Load and process a single image."""
+    def _migrate_database(self, cursor: sqlite3.Cursor):
+        """Bring an existing database up to the current schema version."""
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+
+        if version < 1:
+            # Embeddings used to be stored base64-encoded; store raw float32 bytes instead
+            rows = cursor.execute("SELECT id, embedding FROM images").fetchall()
+            cursor.executemany(
+                "UPDATE images SET embedding = ? WHERE id = ?",
+                [(base64.b64decode(embedding), id_) for id_, embedding in rows]
+            )
+            cursor.execute("PRAGMA user_version = 1")
+
+        if version < 2:
+            # Quantize float32 embeddings to int8 with a per-vector scale
+            cursor.execute("ALTER TABLE images ADD COLUMN scale REAL NOT NULL DEFAULT 1.0")
+            rows = cursor.execute("SELECT id, embedding FROM images").fetchall()
+            updates = []
+            for id_, embedding in rows:
+                quantized, scale = self._quantize(np.frombuffer(embedding, dtype=np.float32))
+                updates.append((quantized.tobytes(), scale, id_))
+            cursor.executemany("UPDATE images SET embedding = ?, scale = ? WHERE id = ?", updates)
+            cursor.execute("PRAGMA user_version = 2")
+
+        if version < 3:
+            # Embeddings are served from a memory-mapped file, addressed by row_index
+            cursor.execute("ALTER TABLE images ADD COLUMN row_index INTEGER")
+            ids = [row[0] for row in cursor.execute("SELECT id FROM images ORDER BY id")]
+            cursor.executemany(
+                "UPDATE images SET row_index = ? WHERE id = ?",
+                [(row_index, id_) for row_index, id_ in enumerate(ids)]
+            )
+            cursor.execute("PRAGMA user_version = 3")
+
+        if version < 4:
+            # Embeddings are L2-normalized before quantization. The int8 values of a rescaled vector
+            # are unchanged, so only the scale needs to be recomputed for the unit-length vector.
+            rows = cursor.execute("SELECT id, embedding FROM images").fetchall()
+            updates = []
+            for id_, embedding in rows:
+                quantized = np.frombuffer(embedding, dtype=np.int8).astype(np.float32)
+                _, scale = self._quantize(self._normalize(quantized))
+                updates.append((scale, id_))
+            cursor.executemany("UPDATE images SET scale = ? WHERE id = ?", updates)
+            cursor.execute("PRAGMA user_version = 4")
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        """L2-normalize embeddings along the last axis as C-contiguous float32."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.sqrt(np.einsum("...d,...d->...", embeddings, embeddings))[..., None]
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(embeddings / norms)
+
+    @staticmethod
+    def _quantize(embedding: np.ndarray) -> tuple:
+        """Quantize a float embedding to int8 with a symmetric per-vector scale."""
+        scale = float(np.max(np.abs(embedding))) / 127 or 1.0
+        quantized = np.round(embedding / scale).astype(np.int8)
+        return quantized, scale
+
+    def _open_embedding_store(self, capacity: int, blocks: Iterable = ()) -> np.memmap:
+        """Create a fresh embedding file with room for `capacity` rows, pre-filled from row blocks."""
+        tmp_path = self.embeddings_path.with_name(self.embeddings_path.name + ".tmp")
+        store = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.int8, shape=(capacity, self._emb_matrix.shape[1])
+        )
+        start = 0
+        for block in blocks:
+            store[start:start + len(block)] = block
+            start += len(block)
+        store.flush()
+        # Swap the file in atomically; readers holding the old mapping keep working
+        os.replace(tmp_path, self.embeddings_path)
+        return np.lib.format.open_memmap(self.embeddings_path, mode="r+")
+
+    def _iter_stored_embeddings(self, batch_size: int = 1024):
+        """Yield the stored embeddings in row_index order, a block of rows at a time."""
+        cursor = self._read_conn.execute("SELECT embedding FROM images ORDER BY row_index")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield np.stack([np.frombuffer(row[0], dtype=np.int8) for row in rows])
+
+    def _load_embeddings(self):
+        """Map the embedding file, rebuilding it from the database if it is missing or stale."""
+        cursor = self._read_conn.cursor()
+        rows = cursor.execute("SELECT id, scale FROM images ORDER BY row_index").fetchall()
+        self._row_ids = [row[0] for row in rows]
+        self._scales = np.array([row[1] for row in rows], dtype=np.float32)
+        count = len(self._row_ids)
+
+        store = None
+        if self.embeddings_path.exists():
+            store = np.lib.format.open_memmap(self.embeddings_path, mode="r+")
+            if store.dtype != np.int8 or store.shape[1] != self._emb_matrix.shape[1] or store.shape[0] < count:
+                store = None
+
+        if store is None:
+            capacity = max(count, self.EMBEDDINGS_INITIAL_CAPACITY)
+            store = self._open_embedding_store(capacity, self._iter_stored_embeddings())
+
+        self._emb_store = store
+        self._emb_matrix = store[:count]
+
+    def _init_ann_index(self):
+        """Load the HNSW index from disk and add any rows stored since it was last saved."""
+        dim = self._emb_matrix.shape[1]
+        total = len(self._row_ids)
+        index = None
+        count = 0
+
+        if self.ann_index_path.exists():
+            index = hnswlib.Index(space="cosine", dim=dim)
+            index.load_index(str(self.ann_index_path))
+            count = index.get_current_count()
+            if count == 0 or count > total:
+                index = None
+                count = 0
+
+        if index is None:
+            index = hnswlib.Index(space="cosine", dim=dim)
+            index.init_index(max_elements=max(total, 1024), ef_construction=200, M=16)
+
+        if count < total:
+            # The index is saved after whole batches, so what it is missing is a row_index suffix
+            if total > index.get_max_elements():
+                index.resize_index(total)
+            index.add_items(self._emb_matrix[count:].astype(np.float32), self._row_ids[count:])
+        self._ann_unsaved = total - count
+        index.set_ef(self.ANN_EF_SEARCH)
+        return index
+
+    def _add_to_ann_index(self, embeddings: np.ndarray, row_ids: list):
+        """Add new embeddings to the HNSW index, growing it as needed."""
+        needed = self._ann_index.get_current_count() + len(row_ids)
+        if needed > self._ann_index.get_max_elements():
+            self._ann_index.resize_index(max(needed, 2 * self._ann_index.get_max_elements()))
+        self._ann_index.add_items(embeddings.astype(np.float32), row_ids)
+        self._ann_unsaved += len(row_ids)
+
+    def _save_ann_index(self):
+        """Write the HNSW index to disk, replacing the previous file atomically.
+
+        Saving is best-effort: the index can always be rebuilt from the embedding matrix on
+        startup, so a failure is logged and retried after another ANN_SAVE_INTERVAL vectors.
+        """
+        with self._ann_save_lock:
+            tmp_path = self.ann_index_path.with_name(self.ann_index_path.name + ".tmp")
+            unsaved = self._ann_unsaved
+            try:
+                self._ann_index.save_index(str(tmp_path))
+                os.replace(tmp_path, self.ann_index_path)
+            except Exception:
+                app.logger.exception("Failed to save the HNSW index to %s", self.ann_index_path)
+                tmp_path.unlink(missing_ok=True)
+                self._ann_next_save = self._ann_unsaved + self.ANN_SAVE_INTERVAL
+                return
+            self._ann_unsaved -= unsaved
+            self._ann_next_save = self.ANN_SAVE_INTERVAL
+
+    def _flush_ann_index(self):
+        """Save the HNSW index at shutdown if it has unsaved vectors."""
+        with self._index_lock:
+            if self._ann_index is not None and self._ann_unsaved:
+                self._save_ann_index()
+
+    def _decode_image(self, image_path: str) -> Image.Image:
+        """Decode an image, shrinking it so its shortest edge matches the CLIP input size."""
         image = Image.open(image_path)
-        inputs = self.processor(images=image, return_tensors="pt", padding=True)
-        inputs['pixel_values'] = inputs['pixel_values'].to(self.device)
-        return inputs
-
-    def compute_image_embedding(self, image_path: str) -> np.ndarray:
-        """Compute embedding for a single image."""
-        inputs = self.load_and_process_image(image_path)
-        with torch.no_grad():
-            image_features = self.model.get_image_features(**inputs)
-        return image_features.cpu().numpy().flatten()
+        # For JPEGs, let libjpeg decode at the smallest DCT scale that still covers the input size
+        image.draft("RGB", (self.image_size, self.image_size))
+        image = image.convert("RGB")
+        scale = self.image_size / min(image.size)
+        if scale < 1:
+            size = (round(image.width * scale), round(image.height * scale))
+            image = image.resize(size, Image.Resampling.BICUBIC)
+        return image
+
+    def _decode_and_preprocess(self, image_path: str) -> np.ndarray:
+        """Pixel values (C x H x W) for one image."""
+        image = self._decode_image(image_path)
+        return self.processor(images=image, return_tensors="np")['pixel_values'][0]
+
+    def _pixel_values_to_device(self, pixel_values: np.ndarray) -> torch.Tensor:
+        """Move a batch of preprocessed pixel values to the model's device and dtype."""
+        pixel_values = torch.from_numpy(pixel_values)
+        if self.device == "cuda":
+            # Pinned host memory lets the copy to the GPU run asynchronously
+            pixel_values = pixel_values.pin_memory()
+        return pixel_values.to(
+            self.device, dtype=self.dtype, memory_format=torch.channels_last, non_blocking=True
+        )
+
+    def _embed_pixel_values(self, pixel_values: np.ndarray) -> np.ndarray:
+        """Run the image tower on a batch of preprocessed pixel values."""
+        if self._vision_session is not None:
+            pixel_values = pixel_values.astype(np.float32, copy=False)
+            return self._vision_session.run(None, {"pixel_values": pixel_values})[0]
+
+        with torch.inference_mode():
+            image_features = self.model.get_image_features(pixel_values=self._pixel_values_to_device(pixel_values))
+        return image_features.float().cpu().numpy()
     
     def compute_text_embedding(self, text: str) -> np.ndarray:
         """Compute embedding for a text query."""
+        if self._text_session is not None:
+            inputs = self.processor(text=text, return_tensors="np", padding=True)
+            feeds = {name: inputs[name].astype(np.int64) for name in ("input_ids", "attention_mask")}
+            return self._text_session.run(None, feeds)[0].flatten()
+
         inputs = self.processor(text=text, return_tensors="pt", padding=True)
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        with torch.no_grad():
+        with torch.inference_mode():
             text_features = self.model.get_text_features(**inputs)
-        return text_features.cpu().numpy().flatten()
+        return text_features.float().cpu().numpy().flatten()
+
+    def _prepare_upload(self, image_path: str, description: Optional[str],
+                        original_filename: Optional[str] = None) -> tuple:
+        """Validate an image and copy it into storage, returning the item to embed."""
+        img = Image.open(image_path)
+        img.verify()
+
+        if description is None or description.strip() == "":
+            description = "No description provided."
+
+        original_filename = original_filename or Path(image_path).name
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # The random part keeps uploads with the same name in the same second apart
+        new_filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{secure_filename(original_filename) or 'image'}"
+        new_path = self.images_dir / new_filename
+
+        shutil.copy2(image_path, new_path)
+        return new_path, new_filename, original_filename, description
+
+    def _submit(self, items: list) -> list:
+        """Hand items to the embedding worker and wait until they are processed.
+
+        Returns one entry per item: its new row id, or the exception that kept it from being stored.
+        """
+        future = Future()
+        self._pending.put((items, future))
+        return future.result()
 
     def add_image(self, image_path: str, description: Optional[str] = None) -> dict:
         """Add a new image to the database and storage."""
         try:
-            img = Image.open(image_path)
-            img.verify()
-
-            if description is None or description.strip() == "":
-                description = "No description provided."
-            
-            original_filename = Path(image_path).name
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            new_filename = f"{timestamp}_{original_filename}"
-            new_path = self.images_dir / new_filename
-
-            shutil.copy2(image_path, new_path)
-            embedding = self.compute_image_embedding(str(new_path))
-            embedding_bytes = base64.b64encode(embedding.tobytes())
-            
-            with sqlite3.connect(self.database_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO images (filename, original_filename, upload_date, description, embedding)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (new_filename, original_filename, datetime.now(), description, embedding_bytes))
-                conn.commit()
-            
-            return {"success": True, "message": f"Image '{original_filename}' added successfully."}
+            item = self._prepare_upload(image_path, description)
+            result, = self._submit([item])
+            if isinstance(result, Exception):
+                raise result
+            return {"success": True, "message": f"Image '{item[2]}' added successfully."}
             
         except Exception as e:
             return {"success": False, "error": str(e)}
 
+    def add_images(self, image_paths: list, descriptions: Optional[list] = None,
+                   original_filenames: Optional[list] = None) -> dict:
+        """Add many images at once, storing all of them in a single transaction.
+
+        Images that fail validation or decoding are listed under "errors"; the rest are still stored.
+        """
+        descriptions = list(descriptions or [])
+        descriptions += [None] * (len(image_paths) - len(descriptions))
+        original_filenames = list(original_filenames or [])
+        original_filenames += [None] * (len(image_paths) - len(original_filenames))
+        try:
+            items = []
+            errors = []
+            for image_path, description, original_filename in zip(image_paths, descriptions, original_filenames):
+                try:
+                    items.append(self._prepare_upload(image_path, description, original_filename))
+                except Exception as e:
+                    errors.append({"filename": original_filename or Path(image_path).name, "error": str(e)})
+
+            row_ids = []
+            for item, result in zip(items, self._submit(items) if items else []):
+                if isinstance(result, Exception):
+                    errors.append({"filename": item[2], "error": str(result)})
+                else:
+                    row_ids.append(result)
+
+            return {
+                "success": not errors,
+                "message": f"{len(row_ids)} image(s) added successfully.",
+                "ids": row_ids,
+                "errors": errors,
+            }
+
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def _embedding_worker(self):
+        """Embed and store queued uploads, coalescing concurrent ones into batches."""
+        while True:
+            jobs = [self._pending.get()]
+            try:
+                while sum(len(items) for items, _ in jobs) < self.BATCH_SIZE:
+                    jobs.append(self._pending.get(timeout=self.BATCH_TIMEOUT))
+            except queue.Empty:
+                pass
+
+            try:
+                batch = [item for items, _ in jobs for item in items]
+                try:
+                    results = self._store_batch(batch)
+                except Exception:
+                    # Nothing from this batch was stored, so drop the copied files as well
+                    for item in batch:
+                        self._remove_upload(item[0])
+                    raise
+
+                start = 0
+                for items, future in jobs:
+                    future.set_result(results[start:start + len(items)])
+                    start += len(items)
+            except Exception as e:
+                # The worker must outlive any failure, and every job it took must be settled,
+                # otherwise its caller waits forever
+                app.logger.exception("Failed to store a batch of uploads")
+                for _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+
+    @staticmethod
+    def _remove_upload(path):
+        """Delete the stored copy of an upload that did not make it into the database."""
+        try:
+            Path(path).unlink(missing_ok=True)
+        except OSError:
+            app.logger.exception("Failed to remove %s", path)
+
+    def _store_batch(self, batch: list) -> list:
+        """Embed uploads BATCH_SIZE at a time and insert all of them in one transaction.
+
+        Returns one entry per item: its new row id, or the exception raised while decoding it.
+        """
+        results = [None] * len(batch)
+
+        def decode_slice(start):
+            return [(i, self._decode_pool.submit(self._decode_and_preprocess, str(batch[i][0])))
+                    for i in range(start, min(start + self.BATCH_SIZE, len(batch)))]
+
+        # Embed each slice as soon as it is decoded while the next one decodes in the background,
+        # so at most two slices of pixel arrays are alive however large the batch is
+        embedded = []
+        kept = []
+        pending = decode_slice(0)
+        for start in range(0, len(batch), self.BATCH_SIZE):
+            decoded, pending = pending, decode_slice(start + self.BATCH_SIZE)
+            pixel_values = []
+            for i, future in decoded:
+                try:
+                    pixel_values.append(future.result())
+                    kept.append(i)
+                except Exception as e:
+                    # An image that cannot be decoded only fails its own upload
+                    results[i] = e
+                    self._remove_upload(batch[i][0])
+            if pixel_values:
+                embedded.append(self._embed_pixel_values(np.stack(pixel_values)))
+
+        if not kept:
+            return results
+
+        embeddings = self._normalize(np.concatenate(embedded))
+        start = len(self._row_ids)
+        quantized = []
+        scales = []
+        rows = []
+        for offset, i in enumerate(kept):
+            _, new_filename, original_filename, description = batch[i]
+            q, scale = self._quantize(embeddings[offset])
+            quantized.append(q)
+            scales.append(scale)
+            rows.append((
+                new_filename, original_filename, datetime.now(), description, q.tobytes(), scale, start + offset
+            ))
+        quantized = np.stack(quantized)
+
+        # Write the rows into the embedding file first, so committed rows always have a vector on disk
+        end = start + len(quantized)
+        if end > self._emb_store.shape[0]:
+            capacity = max(end, 2 * self._emb_store.shape[0])
+            self._emb_store = self._open_embedding_store(capacity, [self._emb_store[:start]])
+        store = self._emb_store
+        store[start:end] = quantized
+        store.flush()
+
+        with self._transaction() as cursor:
+            cursor.executemany(self.INSERT_IMAGE_SQL, rows)
+            # Rows inserted by one statement in one transaction get consecutive ids
+            last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+        row_ids = list(range(last_id - len(rows) + 1, last_id + 1))
+        for i, row_id in zip(kept, row_ids):
+            results[i] = row_id
+
+        # The rows are committed from here on, so nothing below may fail the uploads
+        try:
+            self._publish_rows(store[:end], np.array(scales, dtype=np.float32), quantized, row_ids)
+        except Exception:
+            app.logger.exception("Stored images %s but failed to make them searchable", row_ids)
+        return results
+
+    def _publish_rows(self, matrix: np.ndarray, scales: np.ndarray, quantized: np.ndarray, row_ids: list):
+        """Make newly committed rows visible to search."""
+        with self._index_lock:
+            self._emb_matrix = matrix
+            self._scales = np.append(self._scales, scales)
+            self._row_ids = self._row_ids + row_ids
+            if self._ann_index is not None:
+                try:
+                    self._add_to_ann_index(quantized, row_ids)
+                except Exception:
+                    # An index missing rows would silently drop results; fall back to brute force.
+                    # The next startup adds the missing rows back from the embedding matrix.
+                    app.logger.exception("Failed to add rows to the HNSW index; disabling it until restart")
+                    self._ann_index = None
+                    return
+
+        # Saving rewrites the whole index, so do it rarely and without blocking searches.
+        # Only this worker adds vectors, so the index does not change while it is written.
+        if self._ann_unsaved >= self._ann_next_save:
+            self._save_ann_index()
+
     def get_all_images(self) -> list:
         """Get information about all stored images."""
-        with sqlite3.connect(self.database_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id, filename, original_filename, upload_date, description 
-                FROM images
-            """)
-            results = [
-                {
-                    'id': row[0],
-                    'filename': row[1],
-                    'original_filename': row[2],
-                    'upload_date': row[3],
-                    'description': row[4],
-                    'path': str(self.images_dir / row[1])
-                }
-                for row in cursor.fetchall()
-            ]
-            return results
+        cursor = self._read_conn.cursor()
+        cursor.execute("""
+            SELECT id, filename, original_filename, upload_date, description 
+            FROM images
+        """)
+        results = [
+            {
+                'id': row[0],
+                'filename': row[1],
+                'original_filename': row[2],
+                'upload_date': row[3],
+                'description': row[4],
+                'path': str(self.images_dir / row[1])
+            }
+            for row in cursor.fetchall()
+        ]
+        return results
+
+    def get_image_path(self, image_id: int) -> Optional[Path]:
+        """Get the stored file path of an image, or None if the id is unknown."""
+        row = self._read_conn.execute("SELECT filename FROM images WHERE id = ?", (image_id,)).fetchone()
+        return self.images_dir / row[0] if row else None
+
+    def _fetch_metadata(self, ids: list) -> dict:
+        """Fetch the metadata columns (never the embedding) of the given rows, keyed by id."""
+        rows = {}
+        # Look ids up by primary key in chunks that stay under SQLite's bound-parameter limit
+        for start in range(0, len(ids), self.MAX_SQL_PARAMS):
+            chunk = ids[start:start + self.MAX_SQL_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            cursor = self._read_conn.execute(f"""
+                SELECT id, filename, original_filename, description
+                FROM images WHERE id IN ({placeholders})
+            """, chunk)
+            rows.update((row[0], row) for row in cursor)
+        return rows
+
+    def _similarities(self, query_embedding: np.ndarray, matrix: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        """Cosine similarity of a query embedding against every row of an int8 embedding matrix."""
+        if simsimd is not None:
+            # Cosine is scale-invariant, so the int8 vectors can be compared directly
+            quantized, _ = self._quantize(query_embedding)
+            distances = simsimd.cdist(quantized[None, :], matrix, metric="cosine")
+            return 1 - np.asarray(distances, dtype=np.float32)[0]
+        # Stored rows dequantize to unit vectors, so cosine is a scaled dot product with the normalized query
+        q = self._normalize(query_embedding)
+        if cosine_matrix is not None:
+            sims = np.empty(matrix.shape[0], dtype=np.float32)
+            cosine_matrix(np.asarray(matrix), q, scales, sims)
+            return sims
+        # int8 @ float32 upcasts its operand, so work in blocks to bound the temporary float32 copy
+        sims = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], self.SIMILARITY_BLOCK_ROWS):
+            end = start + self.SIMILARITY_BLOCK_ROWS
+            sims[start:end] = (matrix[start:end].astype(np.float32) @ q) * scales[start:end]
+        return sims
+
+    @staticmethod
+    def _top_k(sims: np.ndarray, k: int) -> np.ndarray:
+        """Indices of the k largest similarities, best first."""
+        if k < sims.shape[0]:
+            # O(N) partial selection, then sort only the k survivors
+            idx = np.argpartition(-sims, k - 1)[:k]
+        else:
+            idx = np.arange(sims.shape[0])
+        return idx[np.argsort(-sims[idx], kind="stable")]
+
+    def _cached_text_embedding(self, query: str) -> np.ndarray:
+        """Text embedding for a query, computed once per distinct normalized query."""
+        key = query.strip().lower()
+        with self._text_cache_lock:
+            embedding = self._text_cache.get(key)
+        if embedding is None:
+            embedding = self.compute_text_embedding(key).astype(np.float32, copy=False)
+            with self._text_cache_lock:
+                self._text_cache[key] = embedding
+        return embedding
 
     def search(self, query: str, top_k: int = 5):
         """Search for images matching the text query."""
-        query_embedding = self.compute_text_embedding(query)
+        # The worker replaces these arrays rather than mutating them, so a snapshot stays consistent
+        with self._index_lock:
+            matrix, scales, row_ids = self._emb_matrix, self._scales, self._row_ids
+            ann_index = self._ann_index
+
+        n = len(row_ids)
+        if n == 0 or top_k <= 0:
+            return []
+
+        query_embedding = self._cached_text_embedding(query)
+        top_k = min(top_k, n)
+
+        if ann_index is not None and n >= self.ANN_MIN_IMAGES:
+            with self._index_lock:
+                labels, distances = ann_index.knn_query(query_embedding, k=top_k)
+            top_ids = [int(label) for label in labels[0]]
+            top_sims = 1 - distances[0]
+        else:
+            sims = self._similarities(query_embedding, matrix, scales)
+            idx = self._top_k(sims, top_k)
+            top_ids = [row_ids[i] for i in idx]
+            top_sims = sims[idx]
+
+        rows = self._fetch_metadata(top_ids)
+
         results = []
-        
-        with sqlite3.connect(self.database_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, filename, original_filename, description, embedding FROM images")
-            
-            for row in cursor.fetchall():
-                id_, filename, original_filename, description, embedding_bytes = row
-                embedding = np.frombuffer(
-                    base64.b64decode(embedding_bytes), 
-                    dtype=np.float32
-                )
-                
-                similarity = np.dot(query_embedding, embedding) / \
-                            (np.linalg.norm(query_embedding) * np.linalg.norm(embedding))
-                
-                results.append({
-                    'id': id_,
-                    'filename': filename,
-                    'original_filename': original_filename,
-                    'description': description,
-                    'similarity': float(similarity),
-                    'path': str(self.images_dir / filename)
-                })
-        
-        # Sort by similarity
-        results.sort(key=lambda x: x['similarity'], reverse=True)
-        return results[:top_k]
+        for id_, similarity in zip(top_ids, top_sims):
+            _, filename, original_filename, description = rows[id_]
+            results.append({
+                'id': id_,
+                'filename': filename,
+                'original_filename': original_filename,
+                'description': description,
+                'similarity': float(similarity),
+                'path': str(self.images_dir / filename)
+            })
+        return results
 
 
 search_engine = ImageSearchEngine()
@@ -172,6 +799,38 @@ def add_image():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/add_images_bulk', methods=['POST'])
+def add_images_bulk():
+    try:
+        files = request.files.getlist('images')
+        descriptions = request.form.getlist('descriptions')
+
+        if not files:
+            return jsonify({"success": False, "error": "At least one image is required."}), 400
+
+        directory = 'temp'
+        os.makedirs(directory, exist_ok=True)
+        file_paths = []
+        try:
+            for file in files:
+                # Unique temp names, so uploads sharing a filename do not overwrite each other
+                file_path = os.path.join(directory, f"{uuid.uuid4().hex}_{secure_filename(file.filename)}")
+                file.save(file_path)
+                file_paths.append(file_path)
+
+            result = search_engine.add_images(
+                file_paths, descriptions, [file.filename for file in files]
+            )
+        finally:
+            for file_path in file_paths:
+                os.remove(file_path)
+
+        # Images that failed validation or decoding are listed under "errors"; the rest are still stored
+        return jsonify(result), 500 if "error" in result else 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/list_images', methods=['GET'])
 def list_images():
     try:
@@ -199,15 +858,9 @@ def search_images():
 @app.route('/download_image/<int:image_id>', methods=['GET'])
 def download_image(image_id):
     try:
-        with sqlite3.connect(search_engine.database_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT filename FROM images WHERE id = ?", (image_id,))
-            row = cursor.fetchone()
-
-            if row:
-                file_path = search_engine.images_dir / row[0]
-                if file_path.exists():
-                    return send_file(file_path, as_attachment=True)
+        file_path = search_engine.get_image_path(image_id)
+        if file_path is not None and file_path.exists():
+            return send_file(file_path, as_attachment=True)
         return jsonify({"success": False, "error": "Image not found."}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,17 @@
+import numba
+
+
+# Compiled eagerly for the engine's int8 matrix layout and cached on disk,
+# so only the very first run of the server pays the JIT cost.
+@numba.njit("void(int8[:, ::1], float32[::1], float32[::1], float32[::1])", parallel=True, fastmath=True, cache=True)
+def cosine_matrix(M, q, scales, out):
+    """Write the cosine similarity of the unit vector q against every row of M into out.
+
+    Row i of M dequantizes to the unit vector M[i] * scales[i], so the cosine
+    is a single scaled dot product.
+    """
+    for i in numba.prange(M.shape[0]):
+        dot = 0.0
+        for j in range(M.shape[1]):
+            dot += M[i, j] * q[j]
+        out[i] = dot * scales[i]